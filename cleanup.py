@@ -10,6 +10,7 @@ import sys
 import time
 import os
 import shutil
+from concurrent import futures
 
 
 class CleanupManager:
@@ -20,6 +21,8 @@ class CleanupManager:
     def __init__(self):
         self.subprocesses = []
         self.directories = []
+        self.background_tasks = []
+        self.cleaned_up = False
 
     def register_subprocess(self, proc):
         self.subprocesses.append(proc)
@@ -27,7 +30,27 @@ class CleanupManager:
     def register_directory(self, directory):
         self.directories.append(directory)
 
+    def register_background_task(self, future, cancel_event):
+        """
+        future is a concurrent.futures.Future of work that stops early once
+        cancel_event is set. It is cancelled and waited for before any
+        directory is removed, so it can't keep writing into one.
+        """
+        self.background_tasks.append((future, cancel_event))
+
     def cleanup(self):
+        # Reached from both the signal handler and error paths, only run once
+        if self.cleaned_up:
+            return
+        self.cleaned_up = True
+
+        for future, cancel_event in self.background_tasks:
+            if not future.done():
+                print("[cleanup] Cancelling background task...")
+            cancel_event.set()
+        for future, _ in self.background_tasks:
+            futures.wait([future])
+
         print(
             "[cleanup] Sending SIGINT to all subprocesses so they can do their own cleanup..."
         )
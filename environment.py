@@ -7,6 +7,8 @@ import logging
 import tempfile
 import subprocess
 import hashlib
+import runpy
+import multiprocessing
 
 from ndcctools.poncho import package_create
 
@@ -18,17 +20,30 @@ def create_conda_pack_from_yml(
     output_file: str = None,
     base_dir: str = "/tmp",
     run_dir: str = "/tmp",
-    manager_name: str = None,
+    env_prefix: str = None,
 ) -> str:
+    """
+    Builds a conda env from env_yml and packs it into output_file (by default
+    a cached pack under <base_dir>/flo_common_env). If env_prefix is given
+    and the pack has to be built, the env is created at env_prefix and left
+    there, so the caller can use it without extracting the pack. On a cache
+    hit nothing is created at env_prefix.
+    """
     common_env_dir = os.path.join(base_dir, "flo_common_env")
     os.makedirs(common_env_dir, exist_ok=True)
 
+    required_packages = ["python", "jupyter", "ndcctools", "cloudpickle"]
+
     if output_file is None:
-        # Generate a unique filename based on the hash of the environment file conent
+        # Generate a unique filename based on the hash of the environment file
+        # content, the solver and the packages added below. Run-specific
+        # settings such as the manager name are not baked into the pack, they
+        # are written into the extracted env instead (see floability-cli.py).
         with open(env_yml, "r") as f:
             raw_content = f.read()
         cleaned_content = "".join(raw_content.split())
-        file_hash = hashlib.md5(cleaned_content.encode("utf-8")).hexdigest()
+        cache_key = "\n".join([cleaned_content, solver, *required_packages])
+        file_hash = hashlib.sha256(cache_key.encode("utf-8")).hexdigest()
 
         output_file = os.path.join(common_env_dir, f"env_{file_hash}.tar.gz")
 
@@ -40,10 +55,8 @@ def create_conda_pack_from_yml(
         )
         return output_file
 
-    required_packages = ["python", "jupyter", "ndcctools", "cloudpickle"]
-
     temp_dir = tempfile.mkdtemp(prefix="conda_env_")
-    env_path = os.path.join(temp_dir, "env")
+    env_path = env_prefix or os.path.join(temp_dir, "env")
 
     try:
         with open(env_yml, "r") as f:
@@ -56,13 +69,8 @@ def create_conda_pack_from_yml(
             if pkg not in env_data["dependencies"]:
                 env_data["dependencies"].append(pkg)
 
-        if "variables" not in env_data:
-            env_data["variables"] = {}
-
-        env_data["variables"]["VINE_MANAGER_NAME"] = manager_name
-
         print(
-            f"[environment] Creating environment with the following packages: {env_data['dependencies']} and variables: {env_data['variables']}"
+            f"[environment] Creating environment with the following packages: {env_data['dependencies']} and variables: {env_data.get('variables', {})}"
         )
 
         modified_yml = os.path.join(temp_dir, "modifed_env.yml")
@@ -92,9 +100,92 @@ def create_conda_pack_from_yml(
 
     except subprocess.CalledProcessError as e:
         print(f"[environment] Error creating or packing environment: {e}")
+        if env_prefix:
+            shutil.rmtree(env_prefix, ignore_errors=True)
         raise
     finally:
         print(f"[environment] Cleaning up temporary directory: {temp_dir}")
         shutil.rmtree(temp_dir, ignore_errors=True)
 
     return output_file
+
+
+# Namespace of the env's conda-unpack script, loaded once per pool worker.
+_UNPACK_NAMESPACE = None
+
+
+def _load_conda_unpack(script_path: str) -> dict:
+    # conda-unpack is generated by conda-pack: the prefix rewriting helpers,
+    # a `_prefix_records` list, and a main guarded by `__name__`. Loading it
+    # under another name gives us the helpers without running the serial loop.
+    return runpy.run_path(script_path, run_name="conda_unpack")
+
+
+def _init_unpack_worker(script_path: str):
+    global _UNPACK_NAMESPACE
+    _UNPACK_NAMESPACE = _load_conda_unpack(script_path)
+
+
+def _rewrite_prefixes(task) -> int:
+    new_prefix, records = task
+    update_prefix = _UNPACK_NAMESPACE["update_prefix"]
+    for path, placeholder, mode in records:
+        update_prefix(
+            os.path.join(new_prefix, path), new_prefix, placeholder, mode=mode
+        )
+    return len(records)
+
+
+def unpack_conda_env(env_dir: str, num_processes: int = None, cancel_event=None):
+    """
+    Equivalent of running <env_dir>/bin/conda-unpack, with the prefix rewrite
+    sharded across num_processes workers (default: all cores). Setting the
+    optional threading.Event cancel_event stops it with a RuntimeError.
+    """
+
+    def check_cancelled():
+        if cancel_event is not None and cancel_event.is_set():
+            raise RuntimeError(f"Relocating '{env_dir}' was cancelled")
+
+    script_path = os.path.join(env_dir, "bin", "conda-unpack")
+    new_prefix = os.path.abspath(env_dir)
+    num_processes = num_processes or os.cpu_count() or 1
+
+    namespace = _load_conda_unpack(script_path)
+    records = namespace.get("_prefix_records")
+
+    if records is None or "update_prefix" not in namespace:
+        # Unknown conda-unpack layout, let the script do its own thing.
+        print("[environment] Running conda-unpack serially.")
+        subprocess.run(
+            [os.path.join(env_dir, "bin", "python"), script_path], check=True
+        )
+        return
+
+    num_processes = min(num_processes, len(records))
+    print(
+        f"[environment] Rewriting prefixes in {len(records)} files using {max(num_processes, 1)} processes..."
+    )
+
+    if num_processes <= 1:
+        update_prefix = namespace["update_prefix"]
+        for path, placeholder, mode in records:
+            check_cancelled()
+            update_prefix(
+                os.path.join(new_prefix, path), new_prefix, placeholder, mode=mode
+            )
+        return
+
+    # Round-robin shards so the few large binaries don't all land in one chunk.
+    tasks = [(new_prefix, records[i::num_processes]) for i in range(num_processes)]
+    # This usually runs in a background thread next to other threads, where
+    # fork() can deadlock, so the workers are spawned instead.
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(
+        num_processes, initializer=_init_unpack_worker, initargs=(script_path,)
+    ) as pool:
+        result = pool.map_async(_rewrite_prefixes, tasks)
+        while not result.ready():
+            check_cancelled()
+            result.wait(timeout=0.5)
+        result.get()
@@ -13,32 +13,362 @@ Example usage:
 """
 
 import argparse
-import time
 import tarfile
 import os
+import shutil
 import subprocess
-import uuid
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from contextlib import closing
+from functools import lru_cache
 
-from environment import create_conda_pack_from_yml
-from resource_provisioner import start_vine_factory
 from cleanup import CleanupManager, install_signal_handlers
-from jupyter_runner import start_jupyterlab
-from utils import create_unique_directory
-from utils import get_system_information
+from utils import create_unique_directory, wait_for_any_exit
 from pathlib import Path
 
-def update_manager_name_in_env(env_dir: str, manager_name: str):
+# Environments given in one of these formats are already packed and are used
+# as-is instead of being built from an environment.yml. They are also passed
+# to vine_factory's --poncho-env, so only what poncho unpacks on the workers
+# (a conda-pack/poncho .tar.gz) is accepted.
+PACKED_ENV_SUFFIXES = (".tar.gz", ".tgz")
+
+# Other archives are rejected rather than mistaken for an environment.yml
+UNSUPPORTED_ENV_SUFFIXES = (".tar", ".bz2", ".xz", ".zst", ".tzst", ".zip")
+
+# Chunk size used when copying member data out of the tar stream. tarfile
+# defaults to 16 KiB, which means a lot of syscalls per GB of env. This is
+# not used as the stream's read buffer: in r| mode every header read slices
+# and copies that buffer, which gets slow when it is this big.
+TAR_COPY_BUFSIZE = 2 * 1024 * 1024
+
+# safe_extract_tar does its own path checks and writes small files itself, so
+# tarfile must not apply an extraction filter of its own (3.14 defaults to
+# "data", which rewrites modes and owners) or members would end up with
+# differing metadata. Pythons without filters behave like "fully_trusted".
+if hasattr(tarfile, "fully_trusted_filter"):
+    TAR_EXTRACT_KWARGS = {"filter": "fully_trusted"}
+else:
+    TAR_EXTRACT_KWARGS = {}
+
+# Regular files up to this size are read into memory by the main thread and
+# written out by a pool of threads, at most EXTRACT_MAX_PENDING at a time.
+# Anything bigger is streamed straight to disk.
+EXTRACT_MAX_FILE_SIZE = 1024 * 1024
+EXTRACT_MAX_PENDING = 64
+
+
+def open_parallel_decompressor(tar_file):
+    """
+    Starts pigz (or igzip) decompressing a gzip'ed tar_file to a pipe, so
+    inflating uses more than one core. Returns None if neither is available.
+    """
+    if not str(tar_file).endswith((".gz", ".tgz")):
+        return None
+
+    for tool in ("pigz", "igzip"):
+        tool_path = shutil.which(tool)
+        if tool_path:
+            return subprocess.Popen(
+                [tool_path, "-dc", str(tar_file)],
+                stdout=subprocess.PIPE,
+                bufsize=1 << 20,
+            )
+
+    return None
+
+
+def iter_archive_members(tar_file):
+    """
+    Streams (tar, member) pairs out of tar_file in a single pass, decompressing
+    gzip'ed archives with pigz/igzip when available.
+    """
+    decompressor = open_parallel_decompressor(tar_file)
+
+    try:
+        try:
+            if decompressor is None:
+                tar = tarfile.open(
+                    tar_file,
+                    mode="r|*",
+                    copybufsize=TAR_COPY_BUFSIZE,
+                )
+            else:
+                tar = tarfile.open(
+                    fileobj=decompressor.stdout,
+                    mode="r|",
+                    copybufsize=TAR_COPY_BUFSIZE,
+                )
+        except tarfile.TarError as e:
+            # If the tool gave up right away (e.g. not gzip at all), that is
+            # the error to report rather than tarfile's "empty file".
+            if decompressor is not None:
+                try:
+                    returncode = decompressor.wait(timeout=1)
+                except subprocess.TimeoutExpired:
+                    returncode = 0
+                if returncode != 0:
+                    raise RuntimeError(
+                        f"Decompressing '{tar_file}' failed with exit code {returncode}"
+                    ) from e
+            raise
+
+        with tar:
+            for member in tar:
+                yield tar, member
+    except BaseException:
+        if decompressor is not None:
+            decompressor.kill()
+            decompressor.wait()
+        raise
+
+    if decompressor is not None:
+        # Drain the end-of-archive padding so the tool doesn't die on EPIPE.
+        decompressor.communicate()
+        if decompressor.returncode != 0:
+            raise RuntimeError(
+                f"Decompressing '{tar_file}' failed with exit code {decompressor.returncode}"
+            )
+
+
+def safe_extract_tar(tar_file, dest_dir, num_threads: int = None, cancel_event=None):
+    """
+    Extracts tar_file into dest_dir in a single streaming pass, refusing any
+    member whose path would land outside dest_dir. Small files are written by
+    num_threads threads (default: ThreadPoolExecutor's) since an env is
+    mostly thousands of small files. dest_dir is expected to be absolute
+    already and is not resolved again here. Setting the optional
+    threading.Event cancel_event stops the extraction with a RuntimeError.
+    """
+    base_resolved = os.path.normpath(os.fspath(dest_dir))
+    base_prefix = base_resolved.rstrip(os.sep) + os.sep
+    base_real = None
+
+    # Paths of the symlinks this extraction has created so far
+    created_symlinks = set()
+
+    # Lexical checks: resolving every member would stat each path component,
+    # which adds up to a lot of syscalls for a large env.
+    def is_within_directory(target: str) -> bool:
+        target = os.path.normpath(target)
+        if target == base_resolved or target.startswith(base_prefix):
+            return True
+        # Paths resolved by real_path() are relative to the real dest_dir
+        return base_real is not None and (
+            target == base_real or target.startswith(base_real + os.sep)
+        )
+
+    # Text alone can't tell where a path goes once it passes through a
+    # symlink from the archive (e.g. `x -> .`, `x/y -> ..`, `x/y/pwned`), so
+    # only those paths are resolved against the filesystem. With follow_leaf
+    # the last component is resolved too, otherwise only its parent.
+    def real_path(path: str, follow_leaf: bool) -> str:
+        nonlocal base_real
+        path = os.path.normpath(path)
+        if not created_symlinks:
+            return path
+
+        probe = path if follow_leaf else os.path.dirname(path)
+        while probe.startswith(base_prefix):
+            if probe in created_symlinks:
+                if base_real is None:
+                    base_real = os.path.realpath(base_resolved)
+                if follow_leaf:
+                    return os.path.realpath(path)
+                parent, leaf = os.path.split(path)
+                return os.path.join(os.path.realpath(parent), leaf)
+            probe = os.path.dirname(probe)
+
+        return path
+
+    def is_safe_member(member: tarfile.TarInfo) -> bool:
+        # A symlink member replaces whatever is at its own path, anything
+        # else (files, dirs, hardlinks) writes through it.
+        member_path = real_path(
+            os.path.join(base_resolved, member.name), follow_leaf=not member.issym()
+        )
+        if not is_within_directory(member_path):
+            return False
+        # Links are checked too, otherwise a later member could be written
+        # through a link that points outside of dest_dir.
+        if member.issym():
+            link_target = os.path.join(os.path.dirname(member_path), member.linkname)
+            return is_within_directory(link_target)
+        if member.islnk():
+            link_target = real_path(
+                os.path.join(base_resolved, member.linkname), follow_leaf=True
+            )
+            return is_within_directory(link_target)
+        return True
+
+    # tarfile can't be read from several threads, so only the writes are
+    # handed off. These are the same steps tarfile does for a regular file.
+    def write_member(tar, member, data):
+        target_path = os.path.join(base_resolved, member.name)
+        with open(target_path, "wb") as f:
+            f.write(data)
+        tar.chown(member, target_path, False)
+        tar.chmod(member, target_path)
+        tar.utime(member, target_path)
+
+    # (path, future) of the writes handed to the pool, in submission order
+    pending = deque()
+    pending_paths = set()
+    created_dirs = set()
+    directories = []
+
+    # Parent directories are created by the main thread only, so the writers
+    # and tarfile's own makedirs never race each other.
+    def make_parent_dir(member):
+        parent_dir = os.path.dirname(os.path.join(base_resolved, member.name))
+        if parent_dir not in created_dirs:
+            os.makedirs(parent_dir, exist_ok=True)
+            created_dirs.add(parent_dir)
+
+    def wait_pending(limit=0):
+        while len(pending) > limit:
+            path, future = pending.popleft()
+            future.result()
+            pending_paths.discard(path)
+
+    with ThreadPoolExecutor(max_workers=num_threads) as pool, closing(
+        iter_archive_members(tar_file)
+    ) as members:
+        try:
+            for tar, member in members:
+                if cancel_event is not None and cancel_event.is_set():
+                    raise RuntimeError(f"Extracting '{tar_file}' was cancelled")
+
+                if not is_safe_member(member):
+                    raise RuntimeError(
+                        f"Refusing to extract '{member.name}' outside of {base_resolved}"
+                    )
+
+                if member.issym():
+                    created_symlinks.add(
+                        os.path.normpath(os.path.join(base_resolved, member.name))
+                    )
+
+                make_parent_dir(member)
+
+                # Anything but a regular file is created by this thread only
+                # once all pending writes are done: a link made at a path
+                # with a write still queued would have that write follow it,
+                # and a hardlink needs its target on disk. Two writes to the
+                # same path are also kept in order, so the last member wins.
+                target_path = os.path.normpath(
+                    os.path.join(base_resolved, member.name)
+                )
+                if not member.isreg() or target_path in pending_paths:
+                    wait_pending()
+
+                if (
+                    member.isreg()
+                    and not member.issparse()
+                    and member.size <= EXTRACT_MAX_FILE_SIZE
+                ):
+                    data = tar.extractfile(member).read()
+                    future = pool.submit(write_member, tar, member, data)
+                    pending.append((target_path, future))
+                    pending_paths.add(target_path)
+                    wait_pending(EXTRACT_MAX_PENDING)
+                    continue
+
+                if member.isdir():
+                    # Like extractall(), set the directory's mode and mtime
+                    # only at the end, so a read-only directory can still be
+                    # filled and its children don't touch its mtime.
+                    tar.extract(
+                        member,
+                        path=base_resolved,
+                        set_attrs=False,
+                        **TAR_EXTRACT_KWARGS,
+                    )
+                    directories.append((tar, member))
+                    continue
+
+                tar.extract(member, path=base_resolved, **TAR_EXTRACT_KWARGS)
+
+            wait_pending()
+
+            # Deepest first, so a parent's mode doesn't block its children
+            directories.sort(key=lambda entry: entry[1].name, reverse=True)
+            for tar, member in directories:
+                dir_path = os.path.join(base_resolved, member.name)
+                tar.chown(member, dir_path, False)
+                tar.utime(member, dir_path)
+                tar.chmod(member, dir_path)
+        except BaseException:
+            for _, future in pending:
+                future.cancel()
+            raise
+
+
+def prepare_conda_env(
+    poncho_env: str,
+    env_dir: str,
+    manager_name: str,
+    num_processes: int = None,
+    cancel_event=None,
+):
+    from environment import unpack_conda_env
+
+    safe_extract_tar(poncho_env, env_dir, cancel_event=cancel_event)
+    update_manager_name_in_env(env_dir, manager_name)
+
+    # This fixes the path after extracting the environment
+    unpack_conda_env(env_dir, num_processes=num_processes, cancel_event=cancel_event)
+
+
+def write_activate_env_vars(env_dir: str, env_vars: dict) -> str:
+    """
+    Appends exports for env_vars to the env's activate.d/env_vars.sh. The new
+    file is written in one go next to the old one and renamed over it, so
+    activation never sees a half-written script.
+    """
     env_vars_dir = os.path.join(env_dir, "etc", "conda", "activate.d")
-    os.makedirs(env_vars_dir, exist_ok=True)
+    try:
+        os.mkdir(env_vars_dir)
+    except FileExistsError:
+        pass
+    except FileNotFoundError:
+        os.makedirs(env_vars_dir, exist_ok=True)
+
     env_vars_file = os.path.join(env_vars_dir, "env_vars.sh")
-    with open(env_vars_file, "a") as f:
-        f.write(f"\nexport VINE_MANAGER_NAME={manager_name}\n")
+    try:
+        with open(env_vars_file, "rb") as f:
+            content = f.read()
+    except FileNotFoundError:
+        content = b""
+
+    content += "".join(
+        f"\nexport {name}={value}\n" for name, value in env_vars.items()
+    ).encode()
+
+    tmp_file = f"{env_vars_file}.tmp"
+    with open(tmp_file, "wb") as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, env_vars_file)
+
+    return env_vars_file
+
+
+def update_manager_name_in_env(env_dir: str, manager_name: str):
+    env_vars_file = write_activate_env_vars(
+        env_dir, {"VINE_MANAGER_NAME": manager_name}
+    )
     print(
         f"[environment] Updated environment variable VINE_MANAGER_NAME={manager_name} in {env_vars_file}"
     )
 
 
-def get_parsed_arguments():
+@lru_cache(maxsize=None)
+def build_argument_parser():
+    # Built once per process; parse_args() can be called on it repeatedly,
+    # e.g. when the CLI is driven from tests or a notebook kernel.
     parser = argparse.ArgumentParser(
         description="Floability CLI: run distributed Jupyter-based workflows with TaskVine."
     )
@@ -79,6 +409,13 @@ def get_parsed_arguments():
         help="Port on which JupyterLab will listen (default=8888).",
     )
 
+    run_parser.add_argument(
+        "--unpack-processes",
+        type=int,
+        default=None,
+        help="Processes used to relocate the extracted environment (default=all cores).",
+    )
+
     run_parser.add_argument(
         "--base-dir",
         default="/tmp",
@@ -88,10 +425,34 @@ def get_parsed_arguments():
     pack_parser = subparsers.add_parser("pack", help="Package a notebook into a Floability backpack")
     verify_parser = subparsers.add_parser("verify", help="Verify a Floability backpack")
      
-    return parser.parse_args()
+    return parser
+
+
+def get_parsed_arguments(argv=None):
+    return build_argument_parser().parse_args(argv)
 
 
 def run_floability(args, cleanup_manager):
+    # Imported here so --help and the other sub-commands don't pay for them
+    from environment import create_conda_pack_from_yml
+    from resource_provisioner import start_vine_factory
+    from jupyter_runner import start_jupyterlab
+
+    if args.environment and args.environment.endswith(".conda"):
+        # A .conda file holds a single package, there is no env to run in
+        print(
+            f"[floability] Error: '{args.environment}' is a conda package, not an environment. "
+            "Pass an environment.yml or a conda-pack/poncho .tar.gz instead."
+        )
+        sys.exit(1)
+
+    if args.environment and args.environment.endswith(UNSUPPORTED_ENV_SUFFIXES):
+        print(
+            f"[floability] Error: '{args.environment}' is not a supported environment. "
+            "Pass an environment.yml or a conda-pack/poncho .tar.gz instead."
+        )
+        sys.exit(1)
+
     run_dir = create_unique_directory(base_dir=args.base_dir, prefix="floability_run")
 
     print(
@@ -100,66 +461,86 @@ def run_floability(args, cleanup_manager):
 
     poncho_env = None
     env_dir = None
+    env_future = None
     
     if args.manager_name is None:
-        args.manager_name = f"floability-{uuid.uuid4()}"
+        import secrets
+
+        args.manager_name = f"floability-{secrets.token_hex(8)}"
 
     print(f"[floability] Manager name: {args.manager_name}")
 
     if args.environment:
-        ext = Path(args.environment).suffix
-        
-        if ext in ['tar', 'gz']:
-            poncho_env = args.environment
+        env_file_path = Path(args.environment).resolve()
+        env_dir = os.path.join(os.path.abspath(run_dir), "current_conda_env")
+        cleanup_manager.register_directory(env_dir)
+
+        if env_file_path.name.endswith(PACKED_ENV_SUFFIXES):
+            poncho_env = str(env_file_path)
         else:
             print(f"[floability] Creating conda-pack from '{args.environment}'")
-            
+
+            # If the pack isn't cached yet, the env is built at env_dir and
+            # packed from there, so it doesn't need to be extracted again.
             poncho_env = create_conda_pack_from_yml(
-                env_yml=args.environment,
+                env_yml=str(env_file_path),
                 solver="libmamba",
                 force=False,
                 base_dir=args.base_dir,
                 run_dir=run_dir,
-                manager_name=args.manager_name,
+                env_prefix=env_dir,
             )
-        
-        env_dir = os.path.join(run_dir, "current_conda_env")
-        os.makedirs(env_dir, exist_ok=True)
-        with tarfile.open(poncho_env, "r:gz") as tar:
-            tar.extractall(path=env_dir)
 
-        update_manager_name_in_env(env_dir, args.manager_name)
-        cleanup_manager.register_directory(env_dir)
+        if os.path.isdir(os.path.join(env_dir, "conda-meta")):
+            print(f"[floability] Using the environment built at {env_dir}")
+            update_manager_name_in_env(env_dir, args.manager_name)
+        else:
+            os.makedirs(env_dir, exist_ok=True)
 
-        # This fixes the path after extracting the environment
-        subprocess.run(
-            [
-                "conda",
-                "run",
-                "--prefix",
+            # vine_factory only needs the tarball, so let the local extraction
+            # run while the factory starts. Jupyter waits for it below.
+            # Cleanup cancels it and waits for it before removing env_dir.
+            env_cancel_event = threading.Event()
+            env_executor = ThreadPoolExecutor(max_workers=1)
+            env_future = env_executor.submit(
+                prepare_conda_env,
+                poncho_env,
                 env_dir,
-                "--no-capture-output",
-                "conda-unpack",
-            ],
-            check=True,
-        )
+                args.manager_name,
+                args.unpack_processes,
+                env_cancel_event,
+            )
+            env_executor.shutdown(wait=False)
+            cleanup_manager.register_background_task(env_future, env_cancel_event)
 
     else:
         print("[floability] No environment file provided, skipping conda-pack.")
 
-    # 2) Start vine_factory
-    factory_proc = start_vine_factory(
-        batch_type=args.batch_type,
-        manager_name=args.manager_name,
-        min_workers=1,
-        max_workers=args.workers,
-        cores_per_worker=args.cores_per_worker,
-        poncho_env=poncho_env,
-        run_dir=run_dir,
-        scratch_dir=run_dir,
-    )
-    cleanup_manager.register_subprocess(factory_proc)
-    
+    try:
+        # 2) Start vine_factory
+        factory_proc = start_vine_factory(
+            batch_type=args.batch_type,
+            manager_name=args.manager_name,
+            min_workers=1,
+            max_workers=args.workers,
+            cores_per_worker=args.cores_per_worker,
+            poncho_env=poncho_env,
+            run_dir=run_dir,
+            scratch_dir=run_dir,
+        )
+        cleanup_manager.register_subprocess(factory_proc)
+
+        if env_future is not None:
+            env_future.result()
+    except BaseException as e:
+        # Also reached on sys.exit() from start_vine_factory or from the
+        # signal handler: stop the env preparation instead of exiting only
+        # once it has finished on its own.
+        if isinstance(e, Exception):
+            print(f"[floability] Failed to prepare the conda environment: {e}")
+        cleanup_manager.cleanup()
+        raise
+
     # 3) Always start Jupyter, even if --notebook not provided
     #    We'll pass None for the notebook_path if not given.
     jupyter_proc = start_jupyterlab(
@@ -170,18 +551,21 @@ def run_floability(args, cleanup_manager):
     )
     cleanup_manager.register_subprocess(jupyter_proc)
     
-    # 4) Main loop
+    # 4) Main loop. Block until one of the processes exits instead of polling.
     try:
+        running = [factory_proc, jupyter_proc]
         while True:
-            time.sleep(5)
+            exited = wait_for_any_exit(running)
+            for proc in exited:
+                running.remove(proc)
 
             # Check if factory exited
-            if factory_proc.poll() is not None:
+            if factory_proc in exited:
                 print("[floability] vine_factory ended.")
                 break
 
             # Check if jupyter ended
-            if jupyter_proc.poll() is not None:
+            if jupyter_proc in exited:
                 print("[floability] JupyterLab ended.")
                 # Optionally break if you want the entire system to stop
                 # break
@@ -0,0 +1,181 @@
+import importlib.util
+import io
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+# floability-cli.py isn't importable by name, load it from its path
+_spec = importlib.util.spec_from_file_location(
+    "floability_cli", os.path.join(REPO_ROOT, "floability-cli.py")
+)
+floability_cli = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(floability_cli)
+
+
+def make_tar(path, members):
+    """
+    members: list of (name, kind, value), kind one of file/dir/sym/hard. value
+    is the content, link target, or for dirs an optional mode.
+    """
+    with tarfile.open(path, "w:gz") as tar:
+        for name, kind, value in members:
+            info = tarfile.TarInfo(name)
+            if kind == "file":
+                info.size = len(value)
+                info.mode = 0o644
+                tar.addfile(info, io.BytesIO(value))
+                continue
+            if kind == "dir":
+                info.type = tarfile.DIRTYPE
+                info.mode = 0o755 if value is None else value
+            elif kind == "sym":
+                info.type = tarfile.SYMTYPE
+                info.linkname = value
+            elif kind == "hard":
+                info.type = tarfile.LNKTYPE
+                info.linkname = value
+            tar.addfile(info)
+
+
+class SafeExtractTarTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.dest_dir = os.path.join(self.tmp.name, "dest")
+        os.makedirs(self.dest_dir)
+        self.tar_file = os.path.join(self.tmp.name, "env.tar.gz")
+
+    def extract(self, members):
+        make_tar(self.tar_file, members)
+        floability_cli.safe_extract_tar(self.tar_file, self.dest_dir)
+
+    def assert_rejected(self, members):
+        with self.assertRaisesRegex(RuntimeError, "Refusing to extract"):
+            self.extract(members)
+        # nothing may have been written next to dest_dir
+        self.assertEqual(sorted(os.listdir(self.tmp.name)), ["dest", "env.tar.gz"])
+
+    def test_extracts_files_and_links(self):
+        self.extract(
+            [
+                ("bin", "dir", None),
+                ("bin/python", "file", b"#!python"),
+                ("lib/big.so", "file", b"x" * (2 * 1024 * 1024)),
+                ("lib/libfoo.so.1", "file", b"foo"),
+                ("lib/libfoo.so", "sym", "libfoo.so.1"),
+                ("lib/libfoo-hard.so", "hard", "lib/libfoo.so.1"),
+                ("lib64", "sym", "lib"),
+                ("lib64/extra", "file", b"extra"),
+            ]
+        )
+
+        def read(name):
+            with open(os.path.join(self.dest_dir, name), "rb") as f:
+                return f.read()
+
+        self.assertEqual(read("bin/python"), b"#!python")
+        self.assertEqual(len(read("lib/big.so")), 2 * 1024 * 1024)
+        self.assertEqual(read("lib/libfoo.so"), b"foo")
+        self.assertEqual(read("lib/libfoo-hard.so"), b"foo")
+        self.assertEqual(read("lib/extra"), b"extra")
+
+    def test_directory_attributes_are_set_last(self):
+        self.extract(
+            [
+                ("share/ro", "dir", 0o555),
+                ("share/ro/file", "file", b"x"),
+                ("share/ro/sub", "dir", 0o555),
+                ("share/ro/sub/file", "file", b"y"),
+            ]
+        )
+        for name in ("share/ro", "share/ro/sub"):
+            path = os.path.join(self.dest_dir, name)
+            self.addCleanup(os.chmod, path, 0o755)
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o555)
+            # the children written afterwards must not bump the mtime
+            self.assertEqual(os.stat(path).st_mtime, 0)
+        with open(os.path.join(self.dest_dir, "share/ro/sub/file"), "rb") as f:
+            self.assertEqual(f.read(), b"y")
+
+    def test_rejects_parent_traversal(self):
+        self.assert_rejected([("../pwned", "file", b"x")])
+
+    def test_rejects_absolute_path(self):
+        pwned = os.path.join(self.tmp.name, "pwned")
+        self.assert_rejected([(pwned, "file", b"x")])
+
+    def test_rejects_symlink_out_of_dest(self):
+        self.assert_rejected([("out", "sym", ".."), ("out/pwned", "file", b"x")])
+
+    def test_rejects_hardlink_out_of_dest(self):
+        self.assert_rejected([("pwned", "hard", "../env.tar.gz")])
+
+    def test_rejects_symlink_chain_out_of_dest(self):
+        self.assert_rejected(
+            [("x", "sym", "."), ("x/y", "sym", ".."), ("x/y/pwned", "file", b"x")]
+        )
+
+    def test_rejects_write_through_lexically_safe_symlink(self):
+        # `a -> b/..` reads as dest_dir itself but really is its parent
+        self.assert_rejected(
+            [("b", "sym", "."), ("a", "sym", "b/.."), ("a/pwned", "file", b"x")]
+        )
+
+    def test_rejects_hardlink_through_symlink(self):
+        self.assert_rejected(
+            [
+                ("b", "sym", "."),
+                ("a", "sym", "b/.."),
+                ("pwned", "hard", "a/env.tar.gz"),
+            ]
+        )
+
+    def test_symlink_waits_for_pending_write_to_same_path(self):
+        # The write of the regular `f` must not land after `f` has been
+        # replaced by a symlink, it would then follow it out of dest_dir.
+        members = [("b", "sym", "."), ("c", "sym", "b/..")]
+        members += [(f"filler/{i}", "file", b"filler") for i in range(60)]
+        members += [("f", "file", b"payload"), ("f", "sym", "c/secret")]
+
+        def slow_open(*args, **kwargs):
+            time.sleep(0.01)
+            return open(*args, **kwargs)
+
+        with mock.patch.object(floability_cli, "open", slow_open, create=True):
+            self.extract(members)
+
+        self.assertFalse(os.path.lexists(os.path.join(self.tmp.name, "secret")))
+        self.assertTrue(os.path.islink(os.path.join(self.dest_dir, "f")))
+
+    def test_last_member_with_same_name_wins(self):
+        members = [("f", "file", b"first" * 100), ("f", "file", b"second")]
+        self.extract(members)
+        with open(os.path.join(self.dest_dir, "f"), "rb") as f:
+            self.assertEqual(f.read(), b"second")
+
+    @unittest.skipUnless(shutil.which("gzip"), "needs gzip")
+    def test_reports_decompressor_failure(self):
+        with open(self.tar_file, "wb") as f:
+            f.write(b"not gzip at all")
+
+        # gzip -dc stands in for pigz/igzip
+        gzip = shutil.which("gzip")
+        with mock.patch.object(
+            floability_cli.shutil,
+            "which",
+            lambda tool: gzip if tool in ("pigz", "igzip") else None,
+        ):
+            with self.assertRaisesRegex(RuntimeError, "failed with exit code"):
+                floability_cli.safe_extract_tar(self.tar_file, self.dest_dir)
+
+
+if __name__ == "__main__":
+    unittest.main()
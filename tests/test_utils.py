@@ -0,0 +1,45 @@
+import os
+import subprocess
+import sys
+import threading
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utils
+
+
+class WaitForAnyExitTest(unittest.TestCase):
+    def start(self, seconds):
+        proc = subprocess.Popen(["sleep", str(seconds)])
+        self.addCleanup(proc.wait)
+        self.addCleanup(proc.kill)
+        return proc
+
+    def test_returns_the_process_that_exited(self):
+        short, long = self.start(0.2), self.start(30)
+        self.assertEqual(utils.wait_for_any_exit([short, long]), [short])
+
+    def test_fallback_starts_one_waiter_per_process(self):
+        short, shorter, long = self.start(0.4), self.start(0.2), self.start(30)
+        threads_before = threading.active_count()
+
+        with mock.patch.object(
+            utils.os, "pidfd_open", side_effect=OSError, create=True
+        ):
+            self.assertEqual(utils.wait_for_any_exit([short, shorter, long]), [shorter])
+            self.assertEqual(utils.wait_for_any_exit([short, long]), [short])
+
+        # only the waiter for `long` is left once the others have finished
+        deadline = time.monotonic() + 5
+        while threading.active_count() - threads_before > 1:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+        time.sleep(0.1)
+        self.assertEqual(threading.active_count() - threads_before, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
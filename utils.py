@@ -3,6 +3,9 @@ import time
 import datetime
 import getpass
 import socket
+import selectors
+import threading
+import weakref
 
 SYSTEM_INFORMATION = None
 
@@ -32,6 +35,58 @@ def create_unique_directory(base_dir=".", prefix="floability_run", max_attempts=
     )
 
 
+# Fallback for wait_for_any_exit: a single waiter thread per process, kept
+# across calls, which notifies _EXIT_CONDITION once its process has exited.
+_EXIT_CONDITION = threading.Condition()
+_WATCHED_PROCS = weakref.WeakSet()
+
+
+def _watch_exit(proc):
+    if proc in _WATCHED_PROCS:
+        return
+    _WATCHED_PROCS.add(proc)
+
+    def waiter():
+        proc.wait()
+        with _EXIT_CONDITION:
+            _EXIT_CONDITION.notify_all()
+
+    threading.Thread(target=waiter, daemon=True).start()
+
+
+def wait_for_any_exit(procs):
+    """
+    Blocks until at least one of the given subprocess.Popen objects exits and
+    returns the ones that have. Uses pidfds where the platform supports them,
+    otherwise one waiter thread per process, started once.
+    """
+    exited = [proc for proc in procs if proc.poll() is not None]
+    if exited:
+        return exited
+
+    pidfds = []
+    try:
+        with selectors.DefaultSelector() as selector:
+            for proc in procs:
+                pidfd = os.pidfd_open(proc.pid)
+                pidfds.append(pidfd)
+                selector.register(pidfd, selectors.EVENT_READ, proc)
+            selector.select()
+    except (AttributeError, OSError):
+        # No os.pidfd_open (non-Linux, Python < 3.9) or kernel < 5.3
+        for proc in procs:
+            _watch_exit(proc)
+        with _EXIT_CONDITION:
+            _EXIT_CONDITION.wait_for(
+                lambda: any(proc.returncode is not None for proc in procs)
+            )
+    finally:
+        for pidfd in pidfds:
+            os.close(pidfd)
+
+    return [proc for proc in procs if proc.poll() is not None]
+
+
 def get_local_ip():
     try:
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)